@@ -1,11 +1,14 @@
-import sys
 import os
+import asyncio
+import concurrent.futures
+import itertools
+import threading
 import discord
 import json
 import arxiv
 import datetime
 from discord.ext import tasks
-from tools import parse
+from tools import format_results, parse
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -15,10 +18,17 @@ with open(config_path) as config_file:
     config = json.load(config_file)
 
 token = config['token']
+max_messages = config.get('max_messages')
+if max_messages is not None and (type(max_messages) is not int or max_messages < 1):
+    raise ValueError('max_messages must be a positive integer')
+max_query_length = 512
 intents = discord.Intents.default()
 intents.message_content = True
 discord_client = discord.Client(intents=intents)
 arxiv_client = arxiv.Client()
+# arxiv.Client spaces out its requests without a lock, so every search runs
+# on this single worker to keep them one at a time
+arxiv_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 to_process = set()
 
 
@@ -27,6 +37,47 @@ async def on_ready():
     loop.start()
 
 
+def fetch_results(query):
+    return list(format_results(arxiv_client.results(query), max_messages=max_messages))
+
+
+async def stream_results(query):
+    # page through arXiv in a worker thread and hand each message over as
+    # soon as it is full, so posting starts before the search has finished
+    event_loop = asyncio.get_running_loop()
+    messages = asyncio.Queue()
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            results = itertools.takewhile(
+                lambda result: not stopped.is_set(), arxiv_client.results(query))
+            for message in format_results(results, max_messages=max_messages):
+                if stopped.is_set():
+                    break
+                event_loop.call_soon_threadsafe(messages.put_nowait, message)
+        finally:
+            event_loop.call_soon_threadsafe(messages.put_nowait, None)
+
+    producer = event_loop.run_in_executor(arxiv_executor, produce)
+    try:
+        while (message := await messages.get()) is not None:
+            yield message
+    finally:
+        stopped.set()  # stop the search if the consumer gave up
+        await producer  # re-raise errors from the search
+
+
+async def search_topic(topic, since, until):
+    query = parse(topic, since, until)
+    if query is None:
+        return None
+    query.max_results = None
+    # arxiv.Client blocks while paging, so keep it off the event loop
+    return await asyncio.get_running_loop().run_in_executor(
+        arxiv_executor, fetch_results, query)
+
+
 @tasks.loop(seconds=60)
 async def loop():
     await discord_client.wait_until_ready()
@@ -39,34 +90,43 @@ async def loop():
                     to_process.add(channel)
     since = dt_now - datetime.timedelta(days=3)
     until = dt_now - datetime.timedelta(days=2)
-    since_string = datetime.datetime.strftime(since, '%Y%m%d%H%M%S')
-    until_string = datetime.datetime.strftime(until, '%Y%m%d%H%M%S')
     processed = set()
+    # channels sharing a topic share a single arXiv search
+    channels_by_topic = {}
     for channel in to_process:
-        query = parse(
-            channel.topic+" since:{} until:{}".format(since_string, until_string))
-        if query is None:
-            processed.add(channel)
-            await channel.send('Invalid query')
-            break
-        query.max_results = None
-        result = arxiv_client.results(query)
-        return_list = [""]
-        for r in result:
-            # to prevent embedding, output as "<url>"
-            next_content = r.title + '\n<' + str(r) + '>\n'
-            if len(return_list[-1]) + len(next_content) > 2000:
-                return_list.append(next_content)
-            else:
-                return_list[-1] += next_content
-        processed.add(channel)
-        sent = False
-        for ret in return_list:
-            if len(ret) > 0:
-                await channel.send(ret[:-1])  # remove last \n
-                sent = True
-        if not sent:
-            await channel.send('No results found')
+        if channel.topic:
+            channels_by_topic.setdefault(channel.topic, []).append(channel)
+        else:
+            processed.add(channel)  # nothing to search for without a topic
+    topics = list(channels_by_topic)
+    next_search = None
+    try:
+        if topics:
+            next_search = asyncio.create_task(
+                search_topic(topics[0], since, until))
+        for i, topic in enumerate(topics):
+            return_list = await next_search
+            if i + 1 < len(topics):
+                # search arXiv for the next topic while posting this one
+                next_search = asyncio.create_task(
+                    search_topic(topics[i + 1], since, until))
+            for channel in channels_by_topic[topic]:
+                processed.add(channel)
+                if return_list is None:
+                    await channel.send('Invalid query')
+                    continue
+                for ret in return_list:
+                    await channel.send(ret)
+                if not return_list:
+                    await channel.send('No results found')
+    finally:
+        # if posting failed, drop the prefetched search. A search that has
+        # already started keeps running on the worker; only its result is lost
+        if next_search is not None:
+            if not next_search.done():
+                next_search.cancel()
+            elif not next_search.cancelled():
+                next_search.exception()  # retrieve the error of a failed prefetch
     for channel in processed:
         to_process.remove(channel)
 
@@ -77,24 +137,22 @@ async def on_message(message):
         return
     if discord_client.user not in message.mentions:
         return
+    if len(message.content) > max_query_length:
+        await message.channel.send('Query too long')
+        return
     query = parse(message.content)
     if query is None:
         await message.channel.send('Invalid query')
         return
-    result = arxiv_client.results(query)
-    return_list = [""]
-    for r in result:
-        next_content = r.title + '\n<' + str(r) + '>\n'
-        if len(return_list[-1]) + len(next_content) > 2000:
-            return_list.append(next_content)
-        else:
-            return_list[-1] += next_content
     sent = False
-    for ret in return_list:
-        if len(ret) > 0:
-            await message.channel.send(ret[:-1])  # remove last \n
+    results = stream_results(query)
+    try:
+        async for ret in results:
+            await message.channel.send(ret)
             sent = True
-    if sent == False:
+    finally:
+        await results.aclose()
+    if not sent:
         await message.channel.send('No results found')
 
 discord_client.run(token)
@@ -1,81 +1,152 @@
+import collections
 import datetime
+import functools
 import arxiv
 
 default_max_result = 10
+message_threshold = 2000
+truncated_notice = 'Too many results, showing the first {} messages'
+# sort keys are single letters and case-insensitive
 sort_by_dict = {
-    "L": arxiv.SortCriterion.LastUpdatedDate,
     "l": arxiv.SortCriterion.LastUpdatedDate,
-    "R": arxiv.SortCriterion.Relevance,
     "r": arxiv.SortCriterion.Relevance,
-    "S": arxiv.SortCriterion.SubmittedDate,
     "s": arxiv.SortCriterion.SubmittedDate
 }
-search_field = {
+search_field = frozenset({
     "ti", "au", "abs", "co", "jr", "cat", "rn", "id", "all"
-}
+})
 
 default_since = datetime.datetime(1900, 1, 1, 0, 0, 0)
 default_until = datetime.datetime(2100, 1, 1, 0, 0, 0)
+# bounds are given in JST while arXiv expects UTC
+jst_offset = datetime.timedelta(hours=-9)
+jst_end_of_day_offset = datetime.timedelta(days=1, hours=-9)
+date_lengths = {8, 12, 14}
+
+
+def parse_date(body, offset):
+    if len(body) not in date_lengths or not (body.isascii() and body.isdigit()):
+        return None
+    try:
+        return datetime.datetime(
+            int(body[0:4]), int(body[4:6]), int(body[6:8]),
+            int(body[8:10] or 0), int(body[10:12] or 0),
+            int(body[12:14] or 0)) + offset
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_since(body):
+    return parse_date(body, jst_offset)
+
+
+def parse_until(body):
+    if len(body) == 8:
+        return parse_date(body, jst_end_of_day_offset)  # end of the day
+    return parse_date(body, jst_offset)
+
+
+bound_parsers = {
+    'since': parse_since,
+    'until': parse_until
+}
+
+
+def format_date(date):
+    return '{:04d}{:02d}{:02d}{:02d}{:02d}{:02d}'.format(
+        date.year, date.month, date.day, date.hour, date.minute, date.second)
 
 
-def parse(search_query):
+ParsedQuery = collections.namedtuple(
+    'ParsedQuery', ['queries', 'max_results', 'sort_by', 'since', 'until'])
+
+
+@functools.lru_cache(maxsize=256)
+def parse_query(chunks):
     queries = []
     max_results = default_max_result
-    since = default_since
-    until = default_until
+    bounds = {'since': default_since, 'until': default_until}
     sort_by = arxiv.SortCriterion.SubmittedDate
-    chunks = list(search_query.split())
     for chunk in chunks:
-        if chunk in sort_by_dict:
-            sort_by = sort_by_dict[chunk]
-        elif chunk[0] == '<':
+        if len(chunk) == 1 and chunk.lower() in sort_by_dict:
+            sort_by = sort_by_dict[chunk.lower()]
+        elif chunk.startswith('<'):
             continue  # ignore mention chunk
         elif chunk.isdecimal():
             new_max_results = int(chunk)
             if 1 <= new_max_results <= 1000:
                 max_results = new_max_results
-        elif chunk.count(":") == 1:
-            prefix, body = chunk.split(":")
-            if prefix == 'since':
-                if len(body) == 8:
-                    since = datetime.datetime.strptime(
-                        body, '%Y%m%d') + datetime.timedelta(hours=-9)
-                elif len(body) == 12:
-                    since = datetime.datetime.strptime(
-                        body, '%Y%m%d%H%M') + datetime.timedelta(hours=-9)
-                elif len(body) == 14:
-                    since = datetime.datetime.strptime(
-                        body, '%Y%m%d%H%M%S') + datetime.timedelta(hours=-9)
-                else:
+        else:
+            prefix, separator, body = chunk.partition(":")
+            if not separator or ":" in body:
+                return None
+            bound_parser = bound_parsers.get(prefix)
+            if bound_parser is not None:
+                bound = bound_parser(body)
+                if bound is None:
                     return None
-                continue
-            if prefix == 'until':
-                if len(body) == 8:
-                    until = datetime.datetime.strptime(
-                        body, '%Y%m%d') + datetime.timedelta(days=1, hours=-9)  # end of the day
-                elif len(body) == 12:
-                    until = datetime.datetime.strptime(
-                        body, '%Y%m%d%H%M') + datetime.timedelta(hours=-9)
-                elif len(body) == 14:
-                    until = datetime.datetime.strptime(
-                        body, '%Y%m%d%H%M%S') + datetime.timedelta(hours=-9)
+                bounds[prefix] = bound
+            elif prefix in search_field:
+                if "," in body:
+                    queries.extend(
+                        prefix + ":" + keyword for keyword in body.split(","))
                 else:
-                    return None
-                continue
-            if prefix not in search_field:
-                continue
-            keywords = body.split(",")
-            for keyword in keywords:
-                queries.append(prefix + ":" + keyword)
-        else:
-            return None
-    if since != default_since or until != default_until:
+                    queries.append(chunk)  # already in prefix:keyword form
+    return ParsedQuery(tuple(queries), max_results, sort_by,
+                       bounds['since'], bounds['until'])
+
+
+def build_search(parsed):
+    queries = list(parsed.queries)
+    if parsed.since is not default_since or parsed.until is not default_until:
         queries.append('submittedDate:[{} TO {}]'.format(
-            datetime.datetime.strftime(since, '%Y%m%d%H%M%S'), datetime.datetime.strftime(until, '%Y%m%d%H%M%S')))
-    query = " AND ".join(queries)
+            format_date(parsed.since), format_date(parsed.until)))
     return arxiv.Search(
-        query=query,
-        max_results=max_results,
-        sort_by=sort_by,
+        query=" AND ".join(queries),
+        max_results=parsed.max_results,
+        sort_by=parsed.sort_by,
         sort_order=arxiv.SortOrder.Descending
     )
+
+
+def parse(search_query, since=None, until=None):
+    # the split chunks are the cache key, so whitespace variants share it
+    parsed = parse_query(tuple(search_query.split()))
+    if parsed is None:
+        return None
+    # since and until are given in JST and override the bounds in the query
+    if since is not None:
+        parsed = parsed._replace(since=since + jst_offset)
+    if until is not None:
+        parsed = parsed._replace(until=until + jst_offset)
+    # arxiv.Search is mutable, so build a fresh one from the cached result
+    return build_search(parsed)
+
+
+def format_results(results, threshold=message_threshold, max_messages=None):
+    # yields each message as soon as it is full. results is usually a lazy
+    # arxiv generator; stopping once max_messages are sent also stops it
+    # from requesting further pages
+    message = []
+    current_length = 0
+    message_count = 0
+    for r in results:
+        # to prevent embedding, output as "<url>"
+        next_content = r.title + '\n<' + r.entry_id + '>\n'
+        content_length = len(next_content)
+        if current_length + content_length > threshold and message:
+            message_count += 1
+            if max_messages is not None and message_count >= max_messages:
+                # the notice goes into the last message so the cap holds
+                notice = truncated_notice.format(message_count)
+                while message and current_length + len(notice) > threshold:
+                    current_length -= len(message.pop())
+                yield "".join(message) + notice
+                return
+            yield "".join(message)[:-1]  # remove last \n
+            message = []
+            current_length = 0
+        message.append(next_content)
+        current_length += content_length
+    if message:
+        yield "".join(message)[:-1]